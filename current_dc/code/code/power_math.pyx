@@ -0,0 +1,52 @@
+# cython: language_level=3
+"""Compiled PowerMath / StateClassifier
+======================================
+
+Typed drop-in replacements for the pure-Python classes in power_monitor.py,
+picked up automatically when built. Behaviour must stay identical.
+
+Build (in this directory):
+  cythonize -i power_math.pyx
+"""
+
+from libc.math cimport sqrt
+
+_LABELS = ("idle", "running", "fault")
+
+
+cdef class PowerMath:
+    """ADCAverageVoltage -> AmplifierVoltageIn -> ClampCurrent -> RMS -> Power.
+
+    With true_rms the input is already an RMS voltage, so the 1/sqrt(2) step is skipped.
+    """
+    cdef readonly double gain, ct_range, line_voltage
+    cdef readonly int phases
+    cdef readonly bint true_rms
+    cdef double _k_current, _k_power
+
+    def __init__(self, double gain, double ct_range, double line_voltage, int phases,
+                 bint true_rms=False):
+        assert phases in (1, 3), "PHASES must be 1 (single-phase) or 3 (balanced three-phase)"
+        self.gain = gain
+        self.ct_range = ct_range
+        self.line_voltage = line_voltage
+        self.phases = phases
+        self.true_rms = true_rms
+        self._k_current = ct_range / gain if true_rms else ct_range * (1 / sqrt(2)) / gain
+        self._k_power = self._k_current * phases * line_voltage
+
+    cpdef tuple calculate(self, double adc_voltage):
+        return adc_voltage * self._k_current, adc_voltage * self._k_power
+
+
+cdef class StateClassifier:
+    cdef readonly double idle_threshold, fault_threshold
+
+    def __init__(self, double idle_threshold, double fault_threshold):
+        self.idle_threshold = idle_threshold
+        self.fault_threshold = fault_threshold
+
+    cpdef str classify(self, double current_rms):
+        # Same results as the original branches, including NaN -> "running"
+        cdef int idx = 1 - (current_rms < self.idle_threshold) + (current_rms > self.fault_threshold)
+        return _LABELS[idx]
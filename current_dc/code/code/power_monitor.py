@@ -8,7 +8,7 @@ Purpose:
   (ADC averaged voltage -> RMS current -> power) and logs readings to a local CSV.
 
 Hardware:
-  Raspberry Pi + MCP3008 (BCRobotics library) + 50A current clamp (single phase measured,
+  Raspberry Pi + MCP3008 (spidev) + 50A current clamp (single phase measured,
   extrapolated to balanced 3-phase total using PHASES).
 
 Output:
@@ -20,12 +20,23 @@ Extensible:
 
 """
 
-import csv
+import gzip
+import itertools
 import math
+import os
+import queue
+import signal
+import threading
 import time
 from pathlib import Path
-from datetime import datetime
-from typing import List, Dict, Tuple
+from typing import Tuple
+
+import numpy as np
+
+try:  # optional JIT for the window kernel; a numpy fallback is used without it
+    from numba import njit
+except ImportError:  # pragma: no cover
+    njit = None
 
 # ---------------------------------------------------------------------------
 # Configuration
@@ -51,6 +62,13 @@ class Config:
     SAMPLE_RATE_HZ = 50           # Individual sample rate during one averaging window
     AVERAGING_WINDOW = 20         # Samples averaged to produce one record
     SLEEP_BETWEEN_WINDOWS_S = 0   # Optional pause after logging each window
+    BURST_SAMPLING = False        # True => read the whole window back-to-back (ignores SAMPLE_RATE_HZ)
+    SPI_SPEED_HZ = 1_350_000      # MCP3008 max clock at 3.3V
+
+    # True RMS (opt-in): only for a sensor whose output is the AC waveform itself, biased
+    # mid-rail. The window mean (DC bias) is removed, so a DC-level sensor output reads 0.
+    TRUE_RMS = False              # True => sqrt(mean(ac^2)) per window instead of average/sqrt(2)
+    LINE_FREQUENCY_HZ = 50        # Mains frequency; TRUE_RMS windows must span whole cycles of it
 
     # Machine state classification thresholds (Amps RMS)
     IDLE_THRESHOLD = 0.5          # Below => idle
@@ -58,32 +76,76 @@ class Config:
 
     # CSV output configuration
     CSV_PATH = Path("/home/pi/power_monitoring/readings.csv")
-    CSV_FLUSH_INTERVAL = 10       # Flush buffered records every N writes
+    CSV_GZIP = False              # True => append to readings.csv.gz (gzip level 1) to cut SD-card writes
+    CSV_FLUSH_BYTES = 8192        # Flush before buffered rows would format to more than this many bytes
+    CSV_FLUSH_MAX_S = 5.0         # ...or once the oldest buffered row is this many seconds old
 
     # Run limits
     MAX_RECORDS = 0               # 0 => run indefinitely; else stop after N records
 
+    def validate(self):
+        """Reject sampling settings that cannot produce a meaningful reading."""
+        if not self.TRUE_RMS:
+            return
+        if self.BURST_SAMPLING:
+            raise ValueError("TRUE_RMS needs paced sampling; a burst covers a fraction of one mains cycle")
+        # At or near the line frequency the waveform aliases to DC and the mean subtraction removes it
+        if self.SAMPLE_RATE_HZ < 10 * self.LINE_FREQUENCY_HZ:
+            raise ValueError(f"TRUE_RMS needs SAMPLE_RATE_HZ >= {10 * self.LINE_FREQUENCY_HZ} "
+                             f"(10x LINE_FREQUENCY_HZ); got {self.SAMPLE_RATE_HZ}")
+        cycles = self.AVERAGING_WINDOW * self.LINE_FREQUENCY_HZ / self.SAMPLE_RATE_HZ
+        if cycles < 1 or abs(cycles - round(cycles)) > 1e-9:
+            raise ValueError(f"TRUE_RMS window must span whole mains cycles; AVERAGING_WINDOW="
+                             f"{self.AVERAGING_WINDOW} at {self.SAMPLE_RATE_HZ} Hz covers {cycles:g}")
+
 
 # ---------------------------------------------------------------------------
-# ADC Driver (MCP3008 via BCRobotics library)
+# ADC Driver (MCP3008 via spidev)
 # ---------------------------------------------------------------------------
 
-from bcr_mcp3008 import MCP3008  # requires package install; SPI must be enabled
+import spidev  # SPI must be enabled (raspi-config)
 
 class MCP3008ADC:
-    """Simple wrapper around MCP3008 ADC.
+    """MCP3008 ADC driven directly over spidev.
     Converts raw 10-bit reading to voltage using 3.3V reference.
     """
-    def __init__(self, channel: int = 0):
-        self.adc = MCP3008(device=0)
+    def __init__(self, channel: int = 0, speed_hz: int = 1_350_000):
+        self.spi = spidev.SpiDev()
+        self.spi.open(0, 0)
+        self.spi.max_speed_hz = speed_hz
         self.channel = channel
         self._adc_max = (2 ** 10) - 1  # 10-bit resolution
         self._vref = 3.3
+        # Start bit, single-ended mode + channel, padding byte
+        self._cmd = [0x01, (0x08 | channel) << 4, 0x00]
+        self._frames = None  # burst scratch, sized on first sample_burst
+        self._raw = None
 
     def sample_voltage(self) -> float:
-        raw = self.adc.readData(self.channel)
+        rx = self.spi.xfer2(self._cmd)
+        raw = ((rx[1] & 0x03) << 8) | rx[2]
         return (raw / self._adc_max) * self._vref
 
+    def sample_burst(self, out: np.ndarray) -> None:
+        """Fill out with back-to-back conversions, decoded in one NumPy pass.
+
+        The MCP3008 only starts a conversion on a chip-select edge, so each
+        conversion is still its own 3-byte transfer. Scratch arrays are kept
+        between calls so a window allocates nothing.
+        """
+        n = out.size
+        if self._frames is None or len(self._frames) != n:
+            self._frames = np.empty((n, 3), dtype=np.uint8)
+            self._raw = np.empty(n, dtype=np.uint16)
+        frames, raw = self._frames, self._raw
+        xfer2, cmd = self.spi.xfer2, self._cmd
+        for i in range(n):
+            frames[i] = xfer2(cmd)
+        np.bitwise_and(frames[:, 1], 0x03, out=raw)
+        np.left_shift(raw, 8, out=raw)
+        np.bitwise_or(raw, frames[:, 2], out=raw)
+        np.multiply(raw, self._vref / self._adc_max, out=out)
+
 
 # ---------------------------------------------------------------------------
 # Core Mathematical Logic (Preserved)
@@ -92,20 +154,27 @@ class MCP3008ADC:
 class PowerMath:
     """Implements original transformation:
     ADCAverageVoltage -> AmplifierVoltageIn -> ClampCurrent -> RMS -> Power.
+
+    With true_rms the input is already an RMS voltage, so the 1/sqrt(2) step is skipped.
     """
     ONE_OVER_SQRT2 = 1 / math.sqrt(2)
 
-    def __init__(self, gain: float, ct_range: float, line_voltage: float, phases: int):
+    def __init__(self, gain: float, ct_range: float, line_voltage: float, phases: int,
+                 true_rms: bool = False):
+        assert phases in (1, 3), "PHASES must be 1 (single-phase) or 3 (balanced three-phase)"
         self.gain = gain
         self.ct_range = ct_range
         self.line_voltage = line_voltage
         self.phases = phases
-
-    def calculate(self, avg_adc_voltage: float) -> Tuple[float, float]:
-        amplifier_voltage_in = avg_adc_voltage / self.gain
-        clamp_current = amplifier_voltage_in * self.ct_range
-        rms_current = clamp_current * self.ONE_OVER_SQRT2
-        power_w = self.phases * rms_current * self.line_voltage
+        self.true_rms = true_rms
+        # Every factor except the ADC voltage is fixed for the process lifetime,
+        # so fold the chain (phases included) into two constants once.
+        self._k_current = ct_range / gain if true_rms else ct_range * self.ONE_OVER_SQRT2 / gain
+        self._k_power = self._k_current * phases * line_voltage
+
+    def calculate(self, adc_voltage: float) -> Tuple[float, float]:
+        rms_current = adc_voltage * self._k_current
+        power_w = adc_voltage * self._k_power
         return rms_current, power_w
 
 
@@ -114,16 +183,47 @@ class PowerMath:
 # ---------------------------------------------------------------------------
 
 class StateClassifier:
+    # Indexed by 1 - (current < idle) + (current > fault); assumes idle < fault.
+    # Same results as the original branches, including NaN -> "running".
+    _LABELS = ("idle", "running", "fault")
+
     def __init__(self, idle_threshold: float, fault_threshold: float):
         self.idle_threshold = idle_threshold
         self.fault_threshold = fault_threshold
 
     def classify(self, current_rms: float) -> str:
-        if current_rms < self.idle_threshold:
-            return "idle"
-        if current_rms > self.fault_threshold:
-            return "fault"
-        return "running"
+        return self._LABELS[1 - (current_rms < self.idle_threshold) + (current_rms > self.fault_threshold)]
+
+
+# Compiled replacements (power_math.pyx, built with `cythonize -i`) take over when present
+# and when they agree with the pure-Python classes above on a small reference set.
+try:
+    import power_math as _compiled
+except ImportError:  # pragma: no cover
+    _compiled = None
+
+
+def _compiled_matches(compiled) -> bool:
+    # A stale build (older signature) or an unrelated power_math module counts as a mismatch
+    try:
+        for true_rms in (False, True):
+            ref = PowerMath(100.0, 50.0, 230.0, 3, true_rms)
+            ext = compiled.PowerMath(100.0, 50.0, 230.0, 3, true_rms)
+            for v in (0.0, 0.5, 1.9355, 3.3):
+                if not all(math.isclose(a, b, rel_tol=1e-12) for a, b in zip(ref.calculate(v), ext.calculate(v))):
+                    return False
+        ref, ext = StateClassifier(0.5, 100.0), compiled.StateClassifier(0.5, 100.0)
+        return all(ref.classify(c) == ext.classify(c)
+                   for c in (0.0, 0.49, 0.5, 50.0, 100.0, 100.1, math.nan, math.inf))
+    except Exception:
+        return False
+
+
+if _compiled is not None:
+    if _compiled_matches(_compiled):
+        PowerMath, StateClassifier = _compiled.PowerMath, _compiled.StateClassifier
+    else:  # pragma: no cover
+        print("[WARN] power_math extension is incompatible with the Python reference; using pure Python")
 
 
 # ---------------------------------------------------------------------------
@@ -133,32 +233,187 @@ class StateClassifier:
 class CSVLogger:
     HEADERS = ["timestamp", "device_id", "machine_id", "current_rms", "voltage", "power_w", "state"]
 
-    def __init__(self, path: Path, flush_interval: int):
-        self.path = path
-        self.flush_interval = flush_interval
-        self.buffer: List[Dict] = []
-        self.total_written = 0
+    def __init__(self, path: Path, flush_bytes: int, device_id: str, machine_id: str,
+                 line_voltage: float, compress: bool = False, flush_max_s: float = 5.0):
+        self.path = path.with_name(path.name + ".gz") if compress else path
+        self.flush_bytes = flush_bytes
+        self.compress = compress
+        self.flush_max_s = flush_max_s
+        # Fields constant for the process, pre-formatted for the row template.
+        # No field can contain a comma or newline, so rows need no CSV quoting.
+        ids = f"{device_id},{machine_id}".replace("%", "%%")
+        self._row_fmt = f"%s,{ids},%.4f,{line_voltage:.1f},%.2f,%s\r\n".encode()
+        # Rows are held column-wise and formatted as one block at flush time;
+        # capacity is sized from a wide row (4-digit amps, 7-digit watts) so a
+        # full block stays within flush_bytes for any realistic reading.
+        row_bytes = len(self._row_fmt % (_iso_ms(0).encode(), 9999.0, 9999999.0, b"running"))
+        self.capacity = max(1, flush_bytes // row_bytes)
+        self._ts = np.empty(self.capacity, dtype="S24")
+        self._current = np.empty(self.capacity, dtype=np.float64)
+        self._power = np.empty(self.capacity, dtype=np.float64)
+        self._state = np.empty(self.capacity, dtype="S8")
+        self._n = 0
+        self._block_start = 0.0  # monotonic time the first row of the current block was buffered
+        self.total_written = 0  # rows actually handed to the file, updated by the writer thread
         self.path.parent.mkdir(parents=True, exist_ok=True)
-        if not self.path.exists():
-            self._write_headers()
-
-    def _write_headers(self):
-        with open(self.path, "w", newline="") as f:
-            csv.DictWriter(f, fieldnames=self.HEADERS).writeheader()
-
-    def log(self, record: Dict):
-        self.buffer.append(record)
-        if len(self.buffer) >= self.flush_interval:
+        # Long-lived append handle; each flush is one write (one gzip member when compressing)
+        self._fh = None
+        self._open()
+        # Batches are written by a background thread so disk latency overlaps
+        # with the next sample window instead of stalling the collector loop.
+        self._pending: queue.SimpleQueue = queue.SimpleQueue()
+        self._write_error = None
+        self._writer = threading.Thread(target=self._write_loop, name="csv-writer", daemon=True)
+        self._writer.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _header(self) -> bytes:
+        return (",".join(self.HEADERS) + "\r\n").encode()
+
+    def _encode(self, buf: bytes) -> bytes:
+        if not self.compress:
+            return buf
+        # One complete gzip member per batch (level 1: most of the size win for little CPU).
+        # Readers concatenate members, and a process killed between writes never leaves
+        # an unterminated member for the next run to append after.
+        return gzip.compress(buf, compresslevel=1, mtime=0)
+
+    def _open(self):
+        self._fh = open(self.path, "ab")
+        # Header whenever the file is empty, including the empty file logrotate's `create` leaves
+        if os.fstat(self._fh.fileno()).st_size == 0:
+            self._fh.write(self._encode(self._header()))
+            self._fh.flush()
+
+    def _close_file(self):
+        self._fh.flush()
+        os.fdatasync(self._fh.fileno())
+        self._fh.close()
+
+    def _reopen_if_rotated(self):
+        """Follow logrotate/manual moves: reopen when the path no longer names our file."""
+        try:
+            rotated = os.stat(self.path).st_ino != os.fstat(self._fh.fileno()).st_ino
+        except FileNotFoundError:
+            rotated = True
+        if rotated:
+            self._close_file()
+            self._open()
+
+    def _write_loop(self):
+        while True:
+            batch = self._pending.get()
+            if batch is None:
+                return
+            buf, rows = batch
+            try:
+                self._reopen_if_rotated()
+                self._fh.write(self._encode(buf))
+                self._fh.flush()
+            except Exception as exc:
+                # Surfaced by the next flush()/close(); stop so nothing is written out of order
+                self._write_error = exc
+                return
+            self.total_written += rows
+
+    def log(self, timestamp: str, current_rms: float, power_w: float, state: str):
+        """Buffer one row; current/power are rounded by the format spec at flush time."""
+        i = self._n
+        self._ts[i] = timestamp
+        self._current[i] = current_rms
+        self._power[i] = power_w
+        self._state[i] = state
+        self._n = i + 1
+        now = time.monotonic()
+        if i == 0:
+            self._block_start = now
+        if self._n == self.capacity or now - self._block_start >= self.flush_max_s:
             self.flush()
 
     def flush(self):
-        if not self.buffer:
+        if self._write_error is not None:
+            raise self._write_error
+        n = self._n
+        if not n:
+            return
+        # One %-format over the repeated row template renders the whole block in C
+        cols = (self._ts[:n].tolist(), self._current[:n].tolist(),
+                self._power[:n].tolist(), self._state[:n].tolist())
+        self._pending.put(((self._row_fmt * n) % tuple(itertools.chain.from_iterable(zip(*cols))), n))
+        self._n = 0
+
+    def close(self):
+        if self._fh is None:
             return
-        with open(self.path, "a", newline="") as f:
-            writer = csv.DictWriter(f, fieldnames=self.HEADERS)
-            writer.writerows(self.buffer)
-        self.total_written += len(self.buffer)
-        self.buffer.clear()
+        try:
+            self.flush()
+        finally:
+            self._pending.put(None)
+            self._writer.join()
+            self._close_file()
+            self._fh = None
+        if self._write_error is not None:
+            raise self._write_error
+
+
+# ---------------------------------------------------------------------------
+# Timestamp Formatting
+# ---------------------------------------------------------------------------
+
+def _iso_ms(ns: int) -> str:
+    """UTC ISO-8601 with milliseconds, e.g. 2025-11-11T12:00:00.123Z."""
+    s, r = divmod(ns, 1_000_000_000)
+    tm = time.gmtime(s)
+    return (f"{tm.tm_year:04d}-{tm.tm_mon:02d}-{tm.tm_mday:02d}"
+            f"T{tm.tm_hour:02d}:{tm.tm_min:02d}:{tm.tm_sec:02d}.{r // 1_000_000:03d}Z")
+
+
+# ---------------------------------------------------------------------------
+# Window Reduction Kernels
+# ---------------------------------------------------------------------------
+# Both take (buf, scratch) so the collector can swap them; scratch is a
+# preallocated array shaped like buf that the fallback RMS squares into.
+
+if njit is not None:
+    @njit(cache=True)
+    def _window_mean(buf, scratch):
+        s = 0.0
+        for i in range(buf.size):
+            s += buf[i]
+        return s / buf.size
+
+    @njit(cache=True)
+    def _window_rms(buf, scratch):
+        """True RMS of the AC component: the window mean (DC bias) is removed first."""
+        n = buf.size
+        mean = 0.0
+        for i in range(n):
+            mean += buf[i]
+        mean /= n
+        acc = 0.0
+        for i in range(n):
+            d = buf[i] - mean
+            acc += d * d
+        return math.sqrt(acc / n)
+else:  # pragma: no cover
+    def _window_mean(buf, scratch):
+        return float(np.add.reduce(buf, dtype=np.float64)) / buf.size
+
+    def _window_rms(buf, scratch):
+        """True RMS of the AC component: the window mean (DC bias) is removed first.
+
+        The AC part is squared in place in scratch; both sums accumulate in
+        float64 inside numpy, without boxing each element into a Python object.
+        """
+        n = buf.size
+        np.subtract(buf, float(np.add.reduce(buf, dtype=np.float64)) / n, out=scratch)
+        np.multiply(scratch, scratch, out=scratch)
+        return math.sqrt(float(np.add.reduce(scratch, dtype=np.float64)) / n)
 
 
 # ---------------------------------------------------------------------------
@@ -167,46 +422,77 @@ class CSVLogger:
 
 class Collector:
     def __init__(self, cfg: Config):
+        cfg.validate()
         self.cfg = cfg
-        self.adc = MCP3008ADC(channel=0)
-        self.math = PowerMath(cfg.AMPLIFIER_GAIN, cfg.CT_RANGE_AMPS, cfg.LINE_VOLTAGE, cfg.PHASES)
+        self.adc = MCP3008ADC(channel=0, speed_hz=cfg.SPI_SPEED_HZ)
+        self.math = PowerMath(cfg.AMPLIFIER_GAIN, cfg.CT_RANGE_AMPS, cfg.LINE_VOLTAGE, cfg.PHASES,
+                              cfg.TRUE_RMS)
         self.classifier = StateClassifier(cfg.IDLE_THRESHOLD, cfg.FAULT_THRESHOLD)
-        self.logger = CSVLogger(cfg.CSV_PATH, cfg.CSV_FLUSH_INTERVAL)
+        self.logger = CSVLogger(cfg.CSV_PATH, cfg.CSV_FLUSH_BYTES, cfg.DEVICE_ID, cfg.MACHINE_ID,
+                                cfg.LINE_VOLTAGE, cfg.CSV_GZIP, cfg.CSV_FLUSH_MAX_S)
         self.record_count = 0
+        # Reused sample buffer for one averaging window (avoids per-window list growth)
+        self._win = np.empty(cfg.AVERAGING_WINDOW, dtype=np.float32)
+        self._scratch = np.empty_like(self._win)
+        self._reduce = _window_rms if cfg.TRUE_RMS else _window_mean
+        # Completed windows as (end time ns, window voltage), an exception from the sampler,
+        # or None from stop()
+        self._windows: queue.SimpleQueue = queue.SimpleQueue()
+        self._stop = threading.Event()
 
     def sample_window(self) -> float:
-        samples = []
+        if self.cfg.BURST_SAMPLING:
+            self.adc.sample_burst(self._win)
+            return float(self._reduce(self._win, self._scratch))
         interval = 1.0 / self.cfg.SAMPLE_RATE_HZ
-        for _ in range(self.cfg.AVERAGING_WINDOW):
-            v = self.adc.sample_voltage()
-            samples.append(v)
-            time.sleep(interval)
-        return sum(samples) / len(samples)
+        # Sleep to absolute deadlines so ADC/Python overhead does not accumulate
+        # and stretch the window beyond its nominal duration.
+        t0 = time.monotonic()
+        for i in range(self._win.size):
+            self._win[i] = self.adc.sample_voltage()
+            remaining = t0 + (i + 1) * interval - time.monotonic()
+            if remaining > 0:
+                time.sleep(remaining)
+        return float(self._reduce(self._win, self._scratch))
+
+    def _sampler(self):
+        """Acquire windows back-to-back on a daemon thread so logging never delays sampling."""
+        try:
+            while not self._stop.is_set():
+                window_v = self.sample_window()
+                self._windows.put((time.time_ns(), window_v))
+                if self.cfg.SLEEP_BETWEEN_WINDOWS_S > 0:
+                    time.sleep(self.cfg.SLEEP_BETWEEN_WINDOWS_S)
+        except Exception as exc:
+            self._windows.put(exc)
+
+    def stop(self):
+        """Ask run() to finish cleanly; safe to call from a signal handler."""
+        self._stop.set()
+        self._windows.put(None)  # SimpleQueue.put is reentrant
 
     def run(self):
-        print(f"[START] Device={self.cfg.DEVICE_ID} Machine={self.cfg.MACHINE_ID} CSV={self.cfg.CSV_PATH}")
+        print(f"[START] Device={self.cfg.DEVICE_ID} Machine={self.cfg.MACHINE_ID} CSV={self.logger.path}")
         print(f"[INFO] Gain={self.cfg.AMPLIFIER_GAIN} CT={self.cfg.CT_RANGE_AMPS} Phases={self.cfg.PHASES} Vline={self.cfg.LINE_VOLTAGE}")
-        while True:
-            avg_v = self.sample_window()
-            current_rms, power_w = self.math.calculate(avg_v)
-            state = self.classifier.classify(current_rms)
-            record = {
-                "timestamp": datetime.utcnow().isoformat(timespec="milliseconds") + "Z",
-                "device_id": self.cfg.DEVICE_ID,
-                "machine_id": self.cfg.MACHINE_ID,
-                "current_rms": round(current_rms, 4),
-                "voltage": round(self.cfg.LINE_VOLTAGE, 1),
-                "power_w": round(power_w, 2),
-                "state": state,
-            }
-            self.logger.log(record)
-            self.record_count += 1
-            if self.cfg.MAX_RECORDS and self.record_count >= self.cfg.MAX_RECORDS:
-                break
-            if self.cfg.SLEEP_BETWEEN_WINDOWS_S > 0:
-                time.sleep(self.cfg.SLEEP_BETWEEN_WINDOWS_S)
-        self.logger.flush()
-        print(f"[END] Wrote {self.logger.total_written} records -> {self.cfg.CSV_PATH}")
+        threading.Thread(target=self._sampler, name="adc-sampler", daemon=True).start()
+        with self.logger:
+            try:
+                while True:
+                    item = self._windows.get()
+                    if item is None:
+                        break
+                    if isinstance(item, Exception):
+                        raise item
+                    ts_ns, window_v = item
+                    current_rms, power_w = self.math.calculate(window_v)
+                    state = self.classifier.classify(current_rms)
+                    self.logger.log(_iso_ms(ts_ns), current_rms, power_w, state)
+                    self.record_count += 1
+                    if self.cfg.MAX_RECORDS and self.record_count >= self.cfg.MAX_RECORDS:
+                        break
+            finally:
+                self._stop.set()
+        print(f"[END] Wrote {self.logger.total_written} records -> {self.logger.path}")
 
 
 # ---------------------------------------------------------------------------
@@ -215,7 +501,10 @@ class Collector:
 
 def main():
     cfg = Config()
-    Collector(cfg).run()
+    collector = Collector(cfg)
+    # systemctl stop sends SIGTERM: finish through run() so buffered rows are written
+    signal.signal(signal.SIGTERM, lambda signum, frame: collector.stop())
+    collector.run()
 
 
 if __name__ == "__main__":  # pragma: no cover